@@ -1,13 +1,34 @@
 import os
 import time
+import asyncio
+import collections
+import functools
 
 import io
 import json
+import base64
+import mimetypes
 import argparse
+import contextlib
+import shutil
+import hashlib
+import tempfile
+import importlib.util
+import httpx
 from dotenv import load_dotenv
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 from PIL import Image
+from tenacity import (
+    AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter,
+)
+
+# orjson is optional, it just parses faster
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # --- Configuration ---
 # Load environment variables from .env file
@@ -15,6 +36,7 @@ load_dotenv()
 
 API_KEY = os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY")
 OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "./output")
+CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "./.img_cache")
 
 # Initialize Client
 client = None
@@ -26,77 +48,261 @@ else:
 
 MODEL_NAME = 'gemini-3-pro-image-preview' # Or appropriate model
 
+def reinit_client(api_key):
+    # Rebuild the client for a new key (e.g. from the GUI settings) without reloading the module
+    global API_KEY, client
+    API_KEY = api_key
+    client = genai.Client(api_key=api_key) if api_key else None
+    return client
+
+# Shared HTTP client for file downloads, so connections are kept alive across videos.
+# HTTP/2 is used when the optional h2 package is installed.
+http_client = httpx.Client(http2=importlib.util.find_spec("h2") is not None, timeout=60)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Max image requests in flight at once for task runs; keep at or below the API RPM limit
+CONCURRENCY = int(os.environ.get("GEMINI_CONCURRENCY", "8"))
+CLEAN_AHEAD = 4 # clean images allowed to run ahead of their dirty counterparts
+# Task-run reference images larger than this (px, longest side) are downscaled before upload; 0 sends them as-is
+BASE_IMAGE_MAX_SIDE = int(os.environ.get("BASE_IMAGE_MAX_SIDE", "512"))
+
+# Directories already created this process, so repeated saves skip the makedirs syscall
+made_dirs = set()
+
+def ensure_dir(path):
+    path = path or "."
+    if path not in made_dirs:
+        os.makedirs(path, exist_ok=True)
+        made_dirs.add(path)
+
 def pil_to_genai_image(pil_image, mime_type="image/png"):
     # Convert PIL Image to types.Image
-    img_byte_arr = io.BytesIO()
     # Force PNG for consistency
-    pil_image.save(img_byte_arr, format='PNG')
-    img_bytes = img_byte_arr.getvalue()
+    with io.BytesIO() as img_byte_arr:
+        pil_image.save(img_byte_arr, format='PNG')
+        img_bytes = img_byte_arr.getvalue()
     return types.Image(image_bytes=img_bytes, mime_type=mime_type)
 
+@contextlib.contextmanager
+def atomic_output(output_path):
+    # Yields a temp path next to output_path and moves it into place only if the block
+    # succeeds, so an interrupted write never leaves a partial file behind
+    ensure_dir(os.path.dirname(output_path))
+    tmp_path = output_path + '.part'
+    try:
+        yield tmp_path
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 def save_image_from_part(part, output_path):
+    # Returns output_path on success. The returned bytes are already an encoded
+    # image, so they are written as-is unless the format doesn't match the extension.
     if part.inline_data and part.inline_data.data:
         try:
             data = part.inline_data.data
-            # Convert bytes to PIL Image to verify/save correctly
-            image = Image.open(io.BytesIO(data))
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            image.save(output_path)
+            with atomic_output(output_path) as tmp_path:
+                if part.inline_data.mime_type == mimetypes.guess_type(output_path)[0]:
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                else:
+                    image_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+                    with io.BytesIO(data) as buf, Image.open(buf) as image:
+                        image.save(tmp_path, format=image_format)
             print(f"Saved to {output_path}")
-            return image
+            return output_path
         except Exception as e:
             print(f"Error saving image content for {output_path}: {e}")
     return None
 
-def generate_image_content(prompt, output_path, base_images=None):
-    print(f"Generating image: {output_path}...")
-    
-    parts = [types.Part.from_text(text=prompt)]
+# Built once and shared by every image request; only read by the SDK
+IMAGE_GENERATION_CONFIG = types.GenerateContentConfig(
+    response_modalities=["IMAGE"],
+    image_config=types.ImageConfig(
+        image_size="1K", # Keeping standard size
+    ),
+    # Using Google Search tool often helps context but might not be strictly needed for pure generation
+    # tools=[types.Tool(google_search=types.GoogleSearch())], 
+)
+
+@functools.lru_cache(maxsize=1024)
+def text_part(prompt):
+    return types.Part.from_text(text=prompt)
+
+def shrink_to_jpeg(image, max_side):
+    # Downscaled JPEG copy of a PIL image for use as a reference
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    else:
+        image = image.copy()
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    with io.BytesIO() as buf:
+        image.save(buf, format='JPEG', quality=85)
+        return buf.getvalue()
+
+def encode_base_image(path, max_side=0):
+    # Returns (bytes, mime_type) for a base image file. With max_side, a reference
+    # image larger than that is sent as a downscaled JPEG to cut upload size; images
+    # meant for editing keep their size and alpha.
+    if max_side:
+        with Image.open(path) as im:
+            if max(im.size) > max_side:
+                # Lets the JPEG decoder skip most of the pixels; no-op for other formats
+                im.draft('RGB', (max_side, max_side))
+                return shrink_to_jpeg(im, max_side), "image/jpeg"
+    # Small enough, send the file's bytes as-is rather than decoding and re-encoding
+    with open(path, 'rb') as f:
+        return f.read(), mimetypes.guess_type(path)[0] or "image/png"
+
+def build_image_request(prompt, base_images=None, history=None, base_max_side=0):
+    # Returns (contents, config) for an image generation call. `history` is an
+    # optional list of earlier turns the new prompt follows on from.
+    parts = [text_part(prompt)]
     
     if base_images:
         if not isinstance(base_images, list):
             base_images = [base_images]
         for base_image in base_images:
-            # If we have base images (PIL Images), convert to bytes for the API
-            try:
-                img_byte_arr = io.BytesIO()
-                base_image.save(img_byte_arr, format=base_image.format or 'PNG')
-                img_bytes = img_byte_arr.getvalue()
-                parts.append(types.Part.from_bytes(data=img_bytes, mime_type="image/png"))
-            except Exception as e:
-                print(f"Error processing base image: {e}")
-                return None
+            img_bytes, mime_type = encode_base_image(base_image, base_max_side)
+            parts.append(types.Part.from_bytes(data=img_bytes, mime_type=mime_type))
 
-    contents = [
+    contents = list(history or []) + [
         types.Content(
             role="user",
             parts=parts,
         ),
     ]
 
-    generate_content_config = types.GenerateContentConfig(
-        response_modalities=["IMAGE"],
-        image_config=types.ImageConfig(
-            image_size="1K", # Keeping standard size
-        ),
-        # Using Google Search tool often helps context but might not be strictly needed for pure generation
-        # tools=[types.Tool(google_search=types.GoogleSearch())], 
-    )
+    return contents, IMAGE_GENERATION_CONFIG
+
+def link_or_copy(src, dst):
+    # Outputs are only ever replaced, never written in place, so sharing the inode is
+    # safe. Falls back to a copy across filesystems.
+    with atomic_output(dst) as tmp_path:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
 
+# --- Image Cache ---
+# Generated images keyed by everything that goes into the request, so re-running
+# unchanged tasks doesn't spend API quota.
+
+def request_cache_key(prompt, base_images=None, output_path=""):
+    # Covers the prompt and the source image files, hashed as saved rather than as
+    # uploaded. A follow-up turn passes the saved files its history refers to, so a
+    # dirty edit of the same clean image hits the cache whether it was sent as a
+    # follow-up turn or with the clean image file attached.
+    digest = hashlib.sha256()
+    digest.update(MODEL_NAME.encode())
+    digest.update(IMAGE_GENERATION_CONFIG.image_config.image_size.encode())
+    digest.update(prompt.encode())
+    if base_images and not isinstance(base_images, list):
+        base_images = [base_images]
+    for base_image in base_images or []:
+        with open(base_image, 'rb') as f:
+            digest.update(f.read())
+    # Saved files are converted to match their extension, so it is part of the key
+    return digest.hexdigest() + os.path.splitext(output_path)[1].lower()
+
+def load_from_cache(cache_key, output_path):
+    cache_path = os.path.join(CACHE_DIR, cache_key)
+    if not os.path.isfile(cache_path) or os.path.getsize(cache_path) == 0:
+        return False
+    link_or_copy(cache_path, output_path)
+    print(f"Cache hit, linked {cache_path} to {output_path}")
+    return True
+
+def store_in_cache(cache_key, output_path):
+    cache_path = os.path.join(CACHE_DIR, cache_key)
     try:
-        # We only expect one image per request for this flow
-        # Using generate_content_stream as per user example to handle potential chunking
-        for chunk in client.models.generate_content_stream(
-            model=MODEL_NAME,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
-                for part in chunk.candidates[0].content.parts:
-                    saved_img = save_image_from_part(part, output_path)
-                    if saved_img:
-                        return saved_img
-        
+        ensure_dir(CACHE_DIR)
+        if os.path.exists(cache_path):
+            return
+        link_or_copy(output_path, cache_path)
+    except Exception as e:
+        print(f"Failed to cache {output_path}: {e}")
+
+# --- Retries ---
+# Rate limits and transient server errors are retried with jittered exponential
+# backoff, or after the server's Retry-After hint when it sends one.
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def is_retryable(error):
+    return isinstance(error, errors.APIError) and error.code in RETRYABLE_STATUS_CODES
+
+def retry_after_seconds(error, default):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return default
+
+backoff = wait_exponential_jitter(initial=1, max=30)
+
+def retry_wait(retry_state):
+    return retry_after_seconds(retry_state.outcome.exception(), backoff(retry_state))
+
+def log_retry(retry_state):
+    print(f"Request failed ({retry_state.outcome.exception()}), retrying in {retry_state.next_action.sleep:.1f}s...")
+
+RETRY_POLICY = dict(
+    stop=stop_after_attempt(4),
+    wait=retry_wait,
+    retry=retry_if_exception(is_retryable),
+    before_sleep=log_retry,
+    reraise=True,
+)
+
+async def generate_image_content_async(prompt, output_path, base_images=None, use_cache=False, history=None, base_max_side=0,
+                                       cache_images=None):
+    # Runs on the async client so many requests can be in flight at once.
+    # With use_cache, identical requests are served from CACHE_DIR instead of the API;
+    # the cache key hashes cache_images (the saved files behind `history`) if given,
+    # or else base_images.
+    # If a `history` list is given, the request continues that conversation and,
+    # when the API answers, the new user and model turns are appended to it.
+    # Base images larger than base_max_side (if set) are shrunk; they are read on a
+    # worker thread so the loop keeps serving the other requests in flight
+    try:
+        contents, generate_content_config = await asyncio.to_thread(build_image_request, prompt, base_images, history, base_max_side)
+    except Exception as e:
+        print(f"Error processing base image: {e}")
+        return None
+
+    cache_key = None
+    if use_cache:
+        cache_key = await asyncio.to_thread(request_cache_key, prompt,
+                                         base_images if cache_images is None else cache_images, output_path)
+        if load_from_cache(cache_key, output_path):
+            return output_path
+
+    print(f"Generating image: {output_path}...")
+    
+    try:
+        async for attempt in AsyncRetrying(**RETRY_POLICY):
+            with attempt:
+                model_parts = []
+                async for chunk in await client.aio.models.generate_content_stream(
+                    model=MODEL_NAME,
+                    contents=contents,
+                    config=generate_content_config,
+                ):
+                    if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
+                        for part in chunk.candidates[0].content.parts:
+                            # Keep every part (including thought signatures) for follow-up turns
+                            model_parts.append(part)
+                            saved_path = save_image_from_part(part, output_path)
+                            if saved_path:
+                                if cache_key:
+                                    store_in_cache(cache_key, output_path)
+                                if history is not None:
+                                    history[:] = contents + [types.Content(role="model", parts=model_parts)]
+                                return saved_path
+
         print(f"No valid image content returned for: {output_path}")
         return None
 
@@ -105,49 +311,272 @@ def generate_image_content(prompt, output_path, base_images=None):
         return None
 
 def load_tasks(tasks_file="tasks.json"):
-    with open(tasks_file, 'r') as f:
-        return json.load(f)
+    with open(tasks_file, 'rb') as f:
+        return json_loads(f.read())
 
-def generate_task_images(task, dirty_only=False):
+def task_paths(task):
     subdir = task.get("subdir", "")
     output_base = os.path.join(OUTPUT_DIR, subdir)
-    os.makedirs(output_base, exist_ok=True)
-    
-    clean_path = os.path.join(output_base, task["clean_file"])
-    dirty_path = os.path.join(output_base, task["dirty_file"])
-    
-    if not dirty_only:
-        # Generate clean image
-        generate_image_content(task["clean_prompt"], clean_path)
-    
-    # Generate dirty image, using clean as base if it exists
-    base_image = None
-    if os.path.exists(clean_path):
+    return (
+        os.path.join(output_base, task["clean_file"]),
+        os.path.join(output_base, task["dirty_file"]),
+    )
+
+def file_ext(path):
+    # Saved files are converted to match their extension, so a duplicate prompt
+    # only shares an image with tasks saving to the same format
+    return os.path.splitext(path)[1].lower()
+
+def task_name(task):
+    return task.get("clean_file", "").replace("-clean", "").replace(".png", "").replace(".jpeg", "").replace(".jpg", "")
+
+def existing_outputs(tasks):
+    # The tasks' clean images already on disk, from one directory listing per output
+    # dir. Only the clean files found are stat-ed, to leave out empty ones so they
+    # get regenerated.
+    listed = set()
+    for output_base in {os.path.dirname(task_paths(task)[0]) for task in tasks}:
         try:
-            base_image = Image.open(clean_path)
-        except:
+            with os.scandir(output_base) as entries:
+                listed.update(os.path.join(output_base, e.name) for e in entries if e.is_file())
+        except FileNotFoundError:
             pass
-    generate_image_content(task["dirty_prompt"], dirty_path, base_image)
+    clean_paths = {task_paths(task)[0] for task in tasks}
+    return {path for path in clean_paths & listed if os.path.getsize(path) > 0}
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Generate before/after images using Gemini API")
-    parser.add_argument("--dirty-only", action="store_true", help="Only regenerate the 'dirty' (before) image, using the existing 'clean' (after) image as context")
-    parser.add_argument("--task", type=str, help="Filter tasks by name (case-insensitive substring match)")
-    
-    args = parser.parse_args()
-    
-    if not client:
-        print("Error: API key not configured. Please set GOOGLE_API_KEY in .env file.")
-        exit(1)
-    
-    tasks = load_tasks()
+async def generate_clean_async(task, sem, existing, dirty_only=False, use_cache=True):
+    # Returns (task, history); history holds the clean request and the model's reply
+    # when the clean image came from the API in this run, or is empty otherwise.
+    # `existing` is the run's set of clean images on disk and is kept up to date.
+    clean_path, _ = task_paths(task)
+    history = []
+    try:
+        ensure_dir(os.path.dirname(clean_path))
+        if not dirty_only:
+            async with sem:
+                if await generate_image_content_async(task["clean_prompt"], clean_path, use_cache=use_cache, history=history):
+                    existing.add(clean_path)
+    except Exception as e:
+        print(f"Task {task['clean_file']} failed: {e}")
+    return task, history
+
+async def generate_dirty_async(task, sem, existing, use_cache=True, history=None):
+    clean_path, dirty_path = task_paths(task)
     
+    if history:
+        # Ask for the dirty version as a follow-up turn, so the model edits the image
+        # it just produced with its own context rather than a fresh upload.
+        # The history may be shared with duplicate tasks, so work on a copy.
+        async with sem:
+            return await generate_image_content_async(task["dirty_prompt"], dirty_path, use_cache=use_cache, history=list(history),
+                                                      cache_images=clean_path)
+
+    # Generate dirty image, using clean as base if it exists. It is only a reference,
+    # so a large one is sent downscaled.
+    base_image = clean_path if clean_path in existing else None
+    async with sem:
+        return await generate_image_content_async(task["dirty_prompt"], dirty_path, base_image, use_cache=use_cache,
+                                                  base_max_side=BASE_IMAGE_MAX_SIDE)
+
+async def link_clean_async(task, leader_job, existing):
+    # Another task has the same clean prompt; reuse its image instead of generating it again
+    leader_task, history = await leader_job
+    leader_clean, _ = task_paths(leader_task)
+    clean_path, _ = task_paths(task)
+    if leader_clean in existing and leader_clean != clean_path:
+        try:
+            link_or_copy(leader_clean, clean_path)
+            existing.add(clean_path)
+            print(f"Linked duplicate clean prompt {leader_clean} -> {clean_path}")
+        except Exception as e:
+            print(f"Task {task['clean_file']} failed: {e}")
+    return task, history
+
+async def link_dirty_async(task, leader_task, leader_job):
+    # Same clean and dirty prompts as another task, so the same base image too
+    leader_dirty = await leader_job
+    _, dirty_path = task_paths(task)
+    if leader_dirty and leader_dirty != dirty_path:
+        link_or_copy(leader_dirty, dirty_path)
+        print(f"Linked duplicate dirty prompt {leader_dirty} -> {dirty_path}")
+        return dirty_path
+    return leader_dirty
+
+async def clean_stream(tasks, sem, existing, dirty_only=False, use_cache=True, ahead=CLEAN_AHEAD):
+    # Yields (task, history) in task order as each clean image finishes, keeping up
+    # to `ahead` clean generations running in front of the consumer.
+    # Tasks sharing a clean prompt (and file format) wait on the first one's job and
+    # link its image.
+    pending = collections.deque()
+    clean_jobs = {}
     for task in tasks:
-        task_name = task.get("clean_file", "").replace("-clean", "").replace(".png", "").replace(".jpeg", "").replace(".jpg", "")
-        if args.task and args.task.lower() not in task_name.lower():
+        key = (task["clean_prompt"], file_ext(task["clean_file"]))
+        leader_job = None if dirty_only else clean_jobs.get(key)
+        if leader_job:
+            job = asyncio.create_task(link_clean_async(task, leader_job, existing))
+        else:
+            job = asyncio.create_task(generate_clean_async(task, sem, existing, dirty_only, use_cache))
+            clean_jobs[key] = job
+        pending.append(job)
+        if len(pending) >= ahead:
+            yield await pending.popleft()
+    while pending:
+        yield await pending.popleft()
+
+async def generate_tasks_async(tasks, dirty_only=False, use_cache=True):
+    # Clean and dirty generations are pipelined: each dirty request starts as soon
+    # as its own clean image is saved, overlapping with later tasks' clean requests.
+    sem = asyncio.Semaphore(CONCURRENCY)
+    existing = existing_outputs(tasks)
+    dirty_jobs = []
+    leaders = {}
+    async for task, history in clean_stream(tasks, sem, existing, dirty_only, use_cache):
+        # Duplicate (clean, dirty) prompt pairs saved to the same formats are generated
+        # once. On --dirty-only runs the base images are separate files, so nothing is
+        # shared.
+        key = (task["clean_prompt"], task["dirty_prompt"], file_ext(task["clean_file"]), file_ext(task["dirty_file"]))
+        leader = None if dirty_only else leaders.get(key)
+        if leader:
+            job = asyncio.create_task(link_dirty_async(task, *leader))
+        else:
+            job = asyncio.create_task(generate_dirty_async(task, sem, existing, use_cache, history))
+            leaders[key] = (task, job)
+        dirty_jobs.append(job)
+
+    results = await asyncio.gather(*dirty_jobs, return_exceptions=True)
+    for task, result in zip(tasks, results):
+        if isinstance(result, Exception):
+            print(f"Task {task['clean_file']} failed: {result}")
+
+# --- Batch Mode ---
+# The batch endpoint schedules requests server-side at reduced cost and without
+# per-minute rate limits, so bulk task runs submit one job per pass instead of
+# one synchronous request per image.
+
+BATCH_POLL_INTERVAL = 30 # seconds
+BATCH_DONE_STATES = ('JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED')
+
+def batch_request_line(key, prompt, base_image_path=None):
+    parts = [{"text": prompt}]
+    if base_image_path:
+        img_bytes, mime_type = encode_base_image(base_image_path, BASE_IMAGE_MAX_SIDE)
+        data = base64.b64encode(img_bytes).decode('ascii')
+        parts.append({"inline_data": {"mime_type": mime_type, "data": data}})
+
+    request = {
+        "contents": [{"role": "user", "parts": parts}],
+        "generation_config": {
+            "responseModalities": ["IMAGE"],
+            "imageConfig": {"imageSize": "1K"},
+        },
+    }
+    return json.dumps({"key": key, "request": request})
+
+def build_batch_jsonl(tasks, dirty=False):
+    # Returns (jsonl_text, {key: output_path}). Keys are the output paths relative
+    # to OUTPUT_DIR so files with the same name in different subdirs don't collide.
+    lines = []
+    outputs = {}
+    existing = existing_outputs(tasks) if dirty else set()
+    for task in tasks:
+        clean_path, dirty_path = task_paths(task)
+        if dirty:
+            if clean_path not in existing:
+                print(f"Skipping dirty image for {task['dirty_file']}: clean image missing.")
+                continue
+            output_path = dirty_path
+            line_base = clean_path
+            prompt = task["dirty_prompt"]
+        else:
+            output_path = clean_path
+            line_base = None
+            prompt = task["clean_prompt"]
+
+        key = os.path.relpath(output_path, OUTPUT_DIR)
+        lines.append(batch_request_line(key, prompt, line_base))
+        outputs[key] = output_path
+    return "\n".join(lines) + "\n", outputs
+
+def run_batch(jsonl_text, display_name):
+    with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+        f.write(jsonl_text)
+        jsonl_path = f.name
+
+    try:
+        uploaded = client.files.upload(
+            file=jsonl_path,
+            config={"display_name": display_name, "mime_type": "jsonl"},
+        )
+    finally:
+        os.remove(jsonl_path)
+
+    batch_job = client.batches.create(
+        model=MODEL_NAME,
+        src=uploaded.name,
+        config={"display_name": display_name},
+    )
+    print(f"Submitted batch job {batch_job.name}")
+
+    while batch_job.state.name not in BATCH_DONE_STATES:
+        print(f"Batch {batch_job.name} is {batch_job.state.name}, checking again in {BATCH_POLL_INTERVAL}s...")
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch_job = client.batches.get(name=batch_job.name)
+
+    if batch_job.state.name != 'JOB_STATE_SUCCEEDED':
+        print(f"Batch {batch_job.name} finished with state {batch_job.state.name}: {batch_job.error}")
+        return []
+
+    result_bytes = client.files.download(file=batch_job.dest.file_name)
+    return [json.loads(line) for line in result_bytes.decode('utf-8').splitlines() if line.strip()]
+
+def save_batch_results(rows, outputs):
+    for row in rows:
+        output_path = outputs.get(row.get("key"))
+        if not output_path:
+            continue
+        if "error" in row:
+            print(f"Failed to generate {output_path}: {row['error']}")
             continue
-        print(f"Processing task: {task_name}")
-        generate_task_images(task, args.dirty_only)
+
+        saved = None
+        for candidate in row.get("response", {}).get("candidates", []):
+            for raw_part in candidate.get("content", {}).get("parts", []):
+                inline = raw_part.get("inlineData") or raw_part.get("inline_data")
+                if not inline:
+                    continue
+                part = types.Part.from_bytes(
+                    data=base64.b64decode(inline["data"]),
+                    mime_type=inline.get("mimeType") or inline.get("mime_type") or "image/png",
+                )
+                saved = save_image_from_part(part, output_path)
+                if saved:
+                    break
+            if saved:
+                break
+
+        if not saved:
+            print(f"No valid image content returned for: {output_path}")
+
+def generate_tasks_batch(tasks, dirty_only=False):
+    if not dirty_only:
+        jsonl_text, outputs = build_batch_jsonl(tasks)
+        if outputs:
+            save_batch_results(run_batch(jsonl_text, "img-batch-clean"), outputs)
+
+    # Second pass needs the clean images on disk to use as the base
+    jsonl_text, outputs = build_batch_jsonl(tasks, dirty=True)
+    if outputs:
+        save_batch_results(run_batch(jsonl_text, "img-batch-dirty"), outputs)
+
+def wait_for_operation(operation, initial=2, factor=1.5, cap=30):
+    # Poll a long-running operation, backing off from `initial` up to `cap` seconds
+    delay = initial
+    while not operation.done:
+        print(f"Waiting for video generation to complete, checking again in {delay:.0f}s...")
+        time.sleep(delay)
+        delay = min(delay * factor, cap)
+        operation = client.operations.get(operation)
+    return operation
 
 def generate_video_content(prompt, output_path, base_images=None, video_mode='text_to_video'):
     print(f"Generating video: {output_path}...")
@@ -206,31 +635,28 @@ def generate_video_content(prompt, output_path, base_images=None, video_mode='te
                 prompt=prompt,
             )
 
-        # Poll the operation status
-        while not operation.done:
-            print("Waiting for video generation to complete...")
-            time.sleep(5) # Poll every 5 seconds
-            operation = client.operations.get(operation)
+        operation = wait_for_operation(operation)
 
         # Download the generated video
         if operation.response.generated_videos:
             generated_video = operation.response.generated_videos[0]
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            ensure_dir(os.path.dirname(output_path))
             
             if generated_video.video.uri:
                 print(f"Downloading video from {generated_video.video.uri}...")
-                import urllib.request
-                
-                # Create a request with the API key header
-                req = urllib.request.Request(
-                    generated_video.video.uri, 
-                    headers={"x-goog-api-key": API_KEY}
-                )
-                
-                with urllib.request.urlopen(req) as response, open(output_path, 'wb') as out_file:
-                    out_file.write(response.read())
+                # Stream to disk so the whole video is never held in memory
+                with http_client.stream(
+                    "GET",
+                    generated_video.video.uri,
+                    headers={"x-goog-api-key": API_KEY},
+                    follow_redirects=True,
+                ) as response, atomic_output(output_path) as tmp_path, open(tmp_path, 'wb') as out_file:
+                    response.raise_for_status()
+                    for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        out_file.write(chunk)
             else:
-                generated_video.video.save(output_path)
+                with atomic_output(output_path) as tmp_path:
+                    generated_video.video.save(tmp_path)
                 
             print(f"Generated video saved to {output_path}")
             return output_path
@@ -241,3 +667,37 @@ def generate_video_content(prompt, output_path, base_images=None, video_mode='te
     except Exception as e:
         print(f"Failed to generate video {output_path}: {e}")
         return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate before/after images using Gemini API")
+    parser.add_argument("--dirty-only", action="store_true", help="Only regenerate the 'dirty' (before) image, using the existing 'clean' (after) image as context")
+    parser.add_argument("--task", type=str, help="Filter tasks by name (case-insensitive substring match)")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the API, even if an identical request has a cached image")
+    parser.add_argument("--batch", action="store_true", help="Submit all images as Gemini Batch API jobs (cheaper, no rate limits, results may take a while)")
+    
+    args = parser.parse_args()
+    
+    if not client:
+        print("Error: API key not configured. Please set GOOGLE_API_KEY in .env file.")
+        exit(1)
+    
+    tasks = load_tasks()
+    
+    task_filter = args.task.lower() if args.task else None
+    selected = []
+    for task in tasks:
+        name = task_name(task)
+        if task_filter and task_filter not in name.lower():
+            continue
+        selected.append((name, task))
+
+    if args.batch:
+        print(f"Submitting {len(selected)} tasks in batch mode")
+        generate_tasks_batch([task for _, task in selected], args.dirty_only)
+        return
+
+    print(f"Processing {len(selected)} tasks: {', '.join(name for name, _ in selected)}")
+    asyncio.run(generate_tasks_async([task for _, task in selected], args.dirty_only, not args.no_cache))
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
 import sys
 import os
 import time
+import asyncio
 import threading
+from collections import OrderedDict
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
     QListWidget, QListWidgetItem, QTextEdit, QLabel, QPushButton, 
-    QSplitter, QInputDialog, QMessageBox, QScrollArea, QFrame, QDialog, QLineEdit, QDialogButtonBox, QFormLayout, QGroupBox, QFileDialog, QComboBox, QAbstractItemView
+    QSplitter, QInputDialog, QMessageBox, QFrame, QDialog, QLineEdit, QDialogButtonBox, QFormLayout, QGroupBox, QFileDialog, QComboBox, QAbstractItemView,
+    QListView, QStyledItemDelegate
 )
-from PySide6.QtCore import Qt, Signal, QObject, QSize, QUrl
-from PySide6.QtGui import QPixmap, QImage, QIcon
+from PySide6.QtCore import Qt, Signal, QObject, QSize, QUrl, QPoint, QRect, QAbstractListModel, QModelIndex, QPersistentModelIndex, QTimer, QRunnable, QThreadPool, QEvent
+from PySide6.QtGui import QPixmap, QImage, QIcon, QFont, QFontMetrics, QImageReader, QImageIOHandler, QPixmapCache, QStaticText, QTextOption, QTransform
 from PySide6.QtMultimedia import QMediaPlayer, QAudioOutput
 from PySide6.QtMultimediaWidgets import QVideoWidget
 from PIL import Image
@@ -18,28 +21,79 @@ import storage
 # --- Cost Settings ---
 COST_PER_IMAGE = 0.04 # Approximate cost for Imagen 3 standard
 
+# --- Generation Settings ---
+GENERATION_THREADS = 4 # video generations whose API calls overlap
+IMAGE_CONCURRENCY = 5 # image requests in flight at once on the async loop
+MAX_PENDING_GENERATIONS = 8 # running + queued before Generate is disabled
+
+# --- Chat View Settings ---
+VIDEO_WIDGET_MARGIN = 800 # px beyond the viewport where video rows keep their player
+HISTORY_CACHE_SIZE = 10 # recently opened conversations kept in memory for instant switching
+
 class WorkerSignals(QObject):
-    finished = Signal(object, str) # result (PIL Image or None), message
-    error = Signal(str)
+    finished = Signal(object, object, str) # worker, result (saved output path), message
+    error = Signal(object, str) # worker, error message
+
+class HistorySignals(QObject):
+    loaded = Signal(str, object, object) # convo_id, history dict with the newest page (or None), media
+    older_loaded = Signal(str, object, object) # convo_id, list of older messages, media
+
+class HistoryLoader(QRunnable):
+    # Reads a page of a conversation's history on the global thread pool: the newest
+    # page with the conversation header, or the page before before_position. The
+    # page's image files are probed here too (see probe_media).
+    def __init__(self, convo_id, signals, before_position=None):
+        super().__init__()
+        self.convo_id = convo_id
+        self.signals = signals
+        self.before_position = before_position
+
+    def run(self):
+        if self.before_position is None:
+            data = storage.load_history(self.convo_id, limit=storage.HISTORY_PAGE_SIZE)
+            media = probe_media(data["history"] if data else [])
+            self.signals.loaded.emit(self.convo_id, data, media)
+        else:
+            msgs = storage.load_history_page(self.convo_id, self.before_position)
+            self.signals.older_loaded.emit(self.convo_id, msgs, probe_media(msgs))
+
+class PreviewSignals(QObject):
+    loaded = Signal(str, object) # QPixmapCache key, QImage
+
+class PreviewLoader(QRunnable):
+    # Decodes a chat image (or a base image icon) at display size on the global
+    # thread pool
+    def __init__(self, source, key, size, signals):
+        super().__init__()
+        self.source = source
+        self.key = key
+        self.size = size
+        self.signals = signals
+
+    def run(self):
+        self.signals.loaded.emit(self.key, load_scaled_image(self.source, self.size))
 
 class VideoPlayer(QWidget):
+    # Shows a still until Play is pressed. One QMediaPlayer and QVideoWidget are
+    # shared by every VideoPlayer and move to whichever one is playing, so the
+    # number of media pipelines doesn't grow with the number of videos in the chat.
+    media = None # (player, audio_output, video_widget), created on the first Play
+    owner = None # the VideoPlayer currently holding them
+
     def __init__(self, video_path, parent=None):
         super().__init__(parent)
         self.setMinimumSize(400, 340)
         # self.setMaximumSize(512, 512)
+        self.video_path = video_path
         
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0,0,0,0)
         
-        self.video_widget = QVideoWidget()
-        layout.addWidget(self.video_widget)
-        
-        self.audio_output = QAudioOutput()
-        self.player = QMediaPlayer()
-        self.player.setAudioOutput(self.audio_output)
-        self.player.setVideoOutput(self.video_widget)
-        self.player.setSource(QUrl.fromLocalFile(os.path.abspath(video_path)))
-        self.audio_output.setVolume(1.0) 
+        self.preview = QLabel()
+        self.preview.setAlignment(Qt.AlignCenter)
+        self.preview.setStyleSheet("background-color: black; color: gray;")
+        layout.addWidget(self.preview, 1)
+        self.show_still()
         
         # Controls
         controls_layout = QHBoxLayout()
@@ -48,43 +102,181 @@ class VideoPlayer(QWidget):
         controls_layout.addWidget(self.play_btn)
         
         layout.addLayout(controls_layout)
+
+    @classmethod
+    def shared_media(cls):
+        if cls.media is None:
+            audio_output = QAudioOutput()
+            audio_output.setVolume(1.0)
+            player = QMediaPlayer()
+            player.setAudioOutput(audio_output)
+            video_widget = QVideoWidget()
+            player.setVideoOutput(video_widget)
+            cls.media = (player, audio_output, video_widget)
+        return cls.media
+
+    def show_still(self):
+        pixmap = video_still(self.video_path)
+        if pixmap is None:
+            self.preview.setText("Video")
+        else:
+            self.preview.setPixmap(pixmap)
+
+    def set_source(self, video_path):
+        # Points a reused player at another file
+        self.release()
+        self.video_path = video_path
+        self.show_still()
+
+    def release(self):
+        # Stops playback and gives the shared player back if this widget holds it
+        if VideoPlayer.owner is self:
+            player, _, video_widget = VideoPlayer.media
+            player.stop()
+            player.setSource(QUrl())
+            video_widget.hide()
+            self.layout().removeWidget(video_widget)
+            video_widget.setParent(None)
+            self.preview.show()
+            VideoPlayer.owner = None
+        self.play_btn.setText("Play")
+
+    def take_media(self):
+        if VideoPlayer.owner is not None:
+            VideoPlayer.owner.release()
+        player, _, video_widget = self.shared_media()
+        self.preview.hide()
+        self.layout().insertWidget(0, video_widget, 1)
+        video_widget.show()
+        player.setSource(QUrl.fromLocalFile(os.path.abspath(self.video_path)))
+        VideoPlayer.owner = self
         
     def toggle_playback(self):
-        if self.player.playbackState() == QMediaPlayer.PlayingState:
-            self.player.pause()
+        if VideoPlayer.owner is not self:
+            self.take_media()
+        player = VideoPlayer.media[0]
+        if player.playbackState() == QMediaPlayer.PlayingState:
+            player.pause()
             self.play_btn.setText("Play")
         else:
-            self.player.play()
+            player.play()
             self.play_btn.setText("Pause")
 
-class GenerationWorker(threading.Thread):
-    def __init__(self, prompt, output_path, base_images=None, video_mode=None, signals=None):
+class AsyncRunner(threading.Thread):
+    # One asyncio event loop on a background thread. Image generations run on it as
+    # coroutines using the SDK's async client, so concurrent requests cost a
+    # coroutine each rather than a blocked thread, limited by a semaphore.
+    def __init__(self, concurrency):
+        super().__init__(name="generation-loop", daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.sem = asyncio.Semaphore(concurrency)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+class GenerationWorker(QRunnable):
+    # One generation, on one of two paths. Videos run on MainWindow's generation pool
+    # (run), since the video SDK call blocks while it polls; images run as a
+    # coroutine on its AsyncRunner (run_async). Results are reported through
+    # signals, which name the worker so its conversation and output path are known
+    # when several generations are in flight.
+    def __init__(self, prompt, output_path, base_image_paths=None, video_mode=None, convo_id=None, use_last_image=False):
         super().__init__()
+        # MainWindow holds the worker until its result is handled
+        self.setAutoDelete(False)
+        self.signals = WorkerSignals()
         self.prompt = prompt
         self.output_path = output_path
-        self.base_images = base_images or []
+        self.base_image_paths = list(base_image_paths or [])
+        self.base_images = []
         self.video_mode = video_mode # None for image, or 'text_to_video', 'bring_to_life', 'reference'
-        self.signals = signals
+        self.convo_id = convo_id
+        self.use_last_image = use_last_image
+        self.preview = None # display-sized QImage of a generated image, decoded here
+
+    def add_last_image(self):
+        # History lookup happens here rather than on the UI thread
+        if self.use_last_image:
+            last_image = storage.last_image_path(self.convo_id)
+            if last_image:
+                self.base_image_paths.append(last_image)
+
+    def make_preview(self, result):
+        thumb_path = storage.make_thumbnails(result)
+        self.preview = load_scaled_image(thumb_path or result, QSize(ChatDelegate.IMAGE_WIDTH, ChatDelegate.IMAGE_WIDTH * 16))
+
+    def report(self, result):
+        if result:
+            self.signals.finished.emit(self, result, "Success")
+        else:
+            self.signals.error.emit(self, "Generation failed (no output returned).")
 
     def run(self):
         try:
             # Check for API KEY
             if not generate_images.client:
-                self.signals.error.emit("API Key not configured. Please set it in Settings.")
+                self.signals.error.emit(self, "API Key not configured. Please set it in Settings.")
                 return
+            self.add_last_image()
 
-            result = None
-            if self.video_mode:
-                result = generate_images.generate_video_content(self.prompt, self.output_path, self.base_images, self.video_mode)
-            else:
-                result = generate_images.generate_image_content(self.prompt, self.output_path, self.base_images)
+            for path in self.base_image_paths:
+                try:
+                    img = Image.open(path)
+                    img.draft("RGB", (1024, 1024))
+                    img.load()
+                    self.base_images.append(img)
+                except Exception as e:
+                    print(f"Failed to load base image {path}: {e}")
+            result = generate_images.generate_video_content(self.prompt, self.output_path, self.base_images, self.video_mode)
+            if result:
+                storage.make_video_thumbnail(result)
+            self.report(result)
+        except Exception as e:
+            self.signals.error.emit(self, str(e))
+        finally:
+            # Release decoded pixel data now rather than whenever the worker is collected
+            for img in self.base_images:
+                img.close()
 
+    async def run_async(self, sem):
+        try:
+            if not generate_images.client:
+                self.signals.error.emit(self, "API Key not configured. Please set it in Settings.")
+                return
+            # File and database work goes to a thread so the loop keeps serving other requests
+            await asyncio.to_thread(self.add_last_image)
+            async with sem:
+                result = await generate_images.generate_image_content_async(self.prompt, self.output_path, self.base_image_paths)
             if result:
-                self.signals.finished.emit(result, "Success")
-            else:
-                self.signals.error.emit("Generation failed (no output returned).")
+                await asyncio.to_thread(self.make_preview, result)
+            self.report(result)
         except Exception as e:
-            self.signals.error.emit(str(e))
+            self.signals.error.emit(self, str(e))
+
+def set_env_value(env_path, key, value):
+    # Rewrites .env in one pass with key set to value. Assignments are collected in a
+    # dict (comments and blank lines keep their place under their line number), and
+    # the file is replaced atomically so a crash can't leave it half written.
+    entries = {}
+    if os.path.exists(env_path):
+        with open(env_path, "r") as f:
+            for i, line in enumerate(f):
+                if not line.endswith("\n"):
+                    line += "\n"
+                if "=" in line and not line.lstrip().startswith("#"):
+                    entries[line.split("=", 1)[0].strip()] = line
+                else:
+                    entries[i] = line
+    entries[key] = f"{key}={value}\n"
+
+    tmp_path = env_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("".join(entries.values()))
+    os.replace(tmp_path, env_path)
 
 class SettingsDialog(QDialog):
     def __init__(self, parent=None):
@@ -110,38 +302,437 @@ class SettingsDialog(QDialog):
         return self.api_key_input.text()
 
 class ChatMessage(QFrame):
+    # Widget for messages that need live child widgets (video playback). Everything
+    # else is painted directly by ChatDelegate. Instances are pooled by MainWindow
+    # and re-pointed at another message with reset().
     def __init__(self, role, text, image_path=None, parent=None):
         super().__init__(parent)
         self.setFrameShape(QFrame.StyledPanel)
         self.layout = QVBoxLayout(self)
         
         # Role Label
-        role_label = QLabel(f"<b>{role.capitalize()}</b>")
-        self.layout.addWidget(role_label)
+        self.role_label = QLabel()
+        self.layout.addWidget(self.role_label)
         
         # Text
-        if text:
-            text_label = QLabel(text)
-            text_label.setWordWrap(True)
-            self.layout.addWidget(text_label)
-        
-        # Image or Video
-        if image_path and os.path.exists(image_path):
-            if image_path.endswith('.mp4'):
-                # Video Player
-                try:
-                    player = VideoPlayer(image_path)
-                    self.layout.addWidget(player)
-                except Exception as e:
-                    self.layout.addWidget(QLabel(f"Error loading video: {e}"))
+        self.text_label = QLabel()
+        self.text_label.setWordWrap(True)
+        self.layout.addWidget(self.text_label)
+        
+        # Video Player, created for the first message that has a video
+        self.player = None
+        self.error_label = QLabel()
+        self.layout.addWidget(self.error_label)
+
+        self.reset(role, text, image_path)
+
+    def reset(self, role, text, image_path=None):
+        self.role_label.setText(f"<b>{role.capitalize()}</b>")
+        self.text_label.setText(text or "")
+        self.text_label.setVisible(bool(text))
+        self.error_label.hide()
+
+        has_video = bool(image_path) and os.path.exists(image_path)
+        if has_video:
+            try:
+                if self.player is None:
+                    self.player = VideoPlayer(image_path)
+                    self.layout.insertWidget(2, self.player)
+                else:
+                    self.player.set_source(image_path)
+            except Exception as e:
+                has_video = False
+                self.error_label.setText(f"Error loading video: {e}")
+                self.error_label.show()
+        if self.player is not None:
+            self.player.setVisible(has_video)
+
+    def release(self):
+        # Called before the widget goes back to the pool
+        if self.player is not None:
+            self.player.release()
+
+def load_scaled_image(image_path, size, transformation=Qt.SmoothTransformation):
+    # Decode as QImage at (about) the size it fits in, then convert the small buffer
+    # once to the premultiplied format QPixmap draws with, so fromImage needs no
+    # extra pass. QImageReader.setScaledSize lets decoders that support it (JPEG)
+    # skip most of the pixels; for the rest it's a full decode plus a smooth scale,
+    # so a fast scale is done here instead when that was asked for.
+    # QImage (unlike QPixmap) can be built off the UI thread.
+    reader = QImageReader(image_path)
+    source_size = reader.size()
+    if source_size.isValid() and (source_size.width() > size.width() or source_size.height() > size.height()):
+        if transformation == Qt.SmoothTransformation or reader.supportsOption(QImageIOHandler.ScaledSize):
+            reader.setScaledSize(source_size.scaled(size, Qt.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        return image
+    if image.width() > size.width() or image.height() > size.height():
+        image = image.scaled(size, Qt.KeepAspectRatio, transformation)
+    image.convertTo(QImage.Format_ARGB32_Premultiplied)
+    return image
+
+def load_scaled_pixmap(image_path, size, transformation=Qt.SmoothTransformation):
+    image = load_scaled_image(image_path, size, transformation)
+    return QPixmap() if image.isNull() else QPixmap.fromImage(image)
+
+VIDEO_EXTS = frozenset({".mp4"})
+
+def is_video_path(path):
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTS
+
+def is_video_message(msg):
+    image_path = msg.get("image")
+    return bool(image_path) and is_video_path(image_path)
+
+CHAT_IMAGE_WIDTH = 512
+BASE_ICON_SIZE = storage.ICON_WIDTH
+
+def display_size(image_path, width=CHAT_IMAGE_WIDTH):
+    # Size an image is shown at in the chat, read from the file header only
+    size = QImageReader(image_path).size()
+    if not size.isValid():
+        return None
+    if size.width() > width:
+        size = QSize(width, round(size.height() * width / size.width()))
+    return size
+
+def pixmap_source(image_path, width=CHAT_IMAGE_WIDTH):
+    # (file to decode, QPixmapCache key). The smallest saved thumbnail that is wide
+    # enough is preferred; the key carries the mtime so an overwritten file is
+    # never served stale, and the display width since what's cached is the
+    # downscaled copy.
+    source = image_path
+    for thumb_width in (storage.ICON_WIDTH, storage.THUMB_WIDTH):
+        thumb_path = storage.get_thumbnail_path(image_path, thumb_width)
+        if thumb_width >= width and os.path.exists(thumb_path):
+            source = thumb_path
+            break
+    return source, f"{source}:{os.path.getmtime(source)}:{width}"
+
+VIDEO_STILL_SIZE = QSize(400, 300)
+
+def video_still(video_path, size=VIDEO_STILL_SIZE):
+    # The video's first-frame thumbnail scaled to fit size, or None if it has none
+    thumb_path = storage.get_thumbnail_path(video_path)
+    if not os.path.exists(thumb_path):
+        return None
+    key = f"{thumb_path}:{os.path.getmtime(thumb_path)}:{size.width()}x{size.height()}"
+    pixmap = QPixmapCache.find(key)
+    if pixmap is None:
+        pixmap = load_scaled_pixmap(thumb_path, size)
+        QPixmapCache.insert(key, pixmap)
+    return pixmap
+
+def probe_media(messages):
+    # Stats and header-reads every image in a page of history, so the UI thread
+    # doesn't have to when the rows are first measured and painted. Returns
+    # {image_path: (display size, pixmap source)}, both None for missing files.
+    media = {}
+    for msg in messages:
+        image_path = msg.get("image")
+        if not image_path or image_path in media or is_video_message(msg):
+            continue
+        if os.path.exists(image_path):
+            media[image_path] = (display_size(image_path), pixmap_source(image_path))
+        else:
+            media[image_path] = (None, None)
+    return media
+
+class ChatModel(QAbstractListModel):
+    # Chat history as a flat list of message dicts (role, text, image)
+    MessageRole = Qt.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        msg = self.messages[index.row()]
+        if role == Qt.DisplayRole:
+            return msg.get("text")
+        if role == self.MessageRole:
+            return msg
+        return None
+
+    def set_messages(self, messages):
+        self.beginResetModel()
+        self.messages = list(messages)
+        self.endResetModel()
+
+    def append_message(self, msg):
+        row = len(self.messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.append(msg)
+        self.endInsertRows()
+
+    def prepend_messages(self, msgs):
+        self.beginInsertRows(QModelIndex(), 0, len(msgs) - 1)
+        self.messages[:0] = msgs
+        self.endInsertRows()
+
+    def remove_first(self):
+        self.beginRemoveRows(QModelIndex(), 0, 0)
+        msg = self.messages.pop(0)
+        self.endRemoveRows()
+        return msg
+
+    def message(self, index):
+        # The stored dict itself; data() hands out a converted copy
+        return self.messages[index.row()]
+
+def first_row_below(view, y):
+    # First row of a list view whose bottom edge is at or below y (viewport
+    # coordinates, which may lie outside the viewport), found with indexAt rather
+    # than by walking from row 0
+    model = view.model()
+    if not model.rowCount():
+        return 0
+    x = view.viewport().width() // 2
+    # A y between two rows lands in their spacing; the next row starts below it
+    for probe in (y, y + 2 * view.spacing() + 1):
+        index = view.indexAt(QPoint(x, probe))
+        if index.isValid():
+            return index.row()
+    # Above the first row, or past the last
+    return 0 if y < view.visualRect(model.index(0)).top() else model.rowCount()
+
+class ChatDelegate(QStyledItemDelegate):
+    # Paints a message (role, wrapped text, image) straight onto the view, so only
+    # rows in the viewport cost anything and no widgets are created per message.
+    # Each message's layout (a prepared QStaticText and the image size) is built
+    # once per text width. Entries are keyed by the message dict's id, so the cache
+    # is cleared whenever the model drops messages.
+    PADDING = 9
+    SPACING = 6
+    IMAGE_WIDTH = CHAT_IMAGE_WIDTH
+    RESIZE_DELAY = 100 # ms the view must stay one width before text is re-wrapped
+    PREFETCH_MARGIN = 5000 # px above and below the viewport whose images are decoded ahead
+    PREFETCH_DELAY = 50 # ms of scroll quiet before prefetching
+    VIDEO_HEIGHT = 360 # room for a VideoPlayer; rows keep it with or without their widget
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+        self._sizes = {}
+        self._pixmap_keys = {}
+        self._image_sizes = {}
+        self._width = None
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(self.RESIZE_DELAY)
+        self.resize_timer.timeout.connect(self.apply_width)
+        view.viewport().installEventFilter(self)
+
+        # Images of rows near the viewport are decoded in the background so they
+        # are already in QPixmapCache when scrolled into view
+        self._prefetching = set()
+        self.preview_signals = PreviewSignals()
+        self.preview_signals.loaded.connect(self.on_preview_loaded)
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(self.PREFETCH_DELAY)
+        self.prefetch_timer.timeout.connect(self.prefetch)
+        view.verticalScrollBar().valueChanged.connect(self.schedule_prefetch)
+        view.model().modelReset.connect(self.schedule_prefetch)
+        view.model().rowsInserted.connect(self.schedule_prefetch)
+
+    def clear_cache(self):
+        self._sizes.clear()
+        self._pixmap_keys.clear()
+
+    def seed(self, media):
+        # Takes file information gathered off the UI thread by probe_media
+        for image_path, (size, source) in media.items():
+            self._image_sizes[image_path] = size
+            if source:
+                self._pixmap_keys[image_path] = source
+
+    def forget(self, msg):
+        # Drop measurements for a message leaving the model, since its id may be reused
+        for key in [key for key in self._sizes if key[0] == id(msg)]:
+            del self._sizes[key]
+
+    def eventFilter(self, obj, event):
+        # While the window is being resized rows keep their current wrapping;
+        # everything is re-laid out once, after the size settles
+        if event.type() == QEvent.Resize and self._width is not None:
+            self.resize_timer.start()
+        return False
+
+    def apply_width(self):
+        width = self._viewport_text_width()
+        if width != self._width:
+            self._width = width
+            self._sizes.clear()
+            self.view.doItemsLayout()
+
+    def _viewport_text_width(self):
+        return max(self.view.viewport().width() - 2 * self.view.spacing() - 2 * self.PADDING, 50)
+
+    def _text_width(self):
+        if self._width is None:
+            self._width = self._viewport_text_width()
+        return self._width
+
+    def _role_font(self, option):
+        font = QFont(option.font)
+        font.setBold(True)
+        return font
+
+    def _image_size(self, image_path):
+        # Displayed size of the attached image, read from the file header only. Kept
+        # across conversation switches, like the decoded pixmaps.
+        if image_path in self._image_sizes:
+            return self._image_sizes[image_path]
+        if not image_path or not os.path.exists(image_path):
+            return None
+        size = display_size(image_path, self.IMAGE_WIDTH)
+        if size:
+            self._image_sizes[image_path] = size
+        return size
+
+    def _layout(self, option, index):
+        # Returns (msg, role_height, static_text, image_size) for a row
+        msg = index.model().message(index)
+        key = (id(msg), self._text_width())
+        cached = self._sizes.get(key)
+        if cached:
+            return cached
+        role_height = QFontMetrics(self._role_font(option)).height()
+        static_text = None
+        if msg.get("text"):
+            # Plain-text QStaticText ignores "\n"; a line separator breaks the line
+            static_text = QStaticText(msg["text"].replace("\n", "\u2028"))
+            static_text.setTextFormat(Qt.PlainText)
+            text_option = QTextOption(Qt.AlignLeft)
+            text_option.setWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
+            static_text.setTextOption(text_option)
+            static_text.setTextWidth(self._text_width())
+            static_text.prepare(QTransform(), option.font)
+        image_size = self._image_size(msg.get("image"))
+        self._sizes[key] = (msg, role_height, static_text, image_size)
+        return self._sizes[key]
+
+    def sizeHint(self, option, index):
+        msg, role_height, static_text, image_size = self._layout(option, index)
+        height = 2 * self.PADDING + role_height
+        if static_text:
+            height += self.SPACING + round(static_text.size().height())
+        if image_size:
+            height += self.SPACING + image_size.height()
+        elif is_video_message(msg):
+            height += self.SPACING + self.VIDEO_HEIGHT
+        return QSize(self.view.viewport().width() - 2 * self.view.spacing(), height)
+
+    def paint(self, painter, option, index):
+        if self.view.indexWidget(index):
+            return
+        msg, role_height, static_text, image_size = self._layout(option, index)
+
+        painter.save()
+        frame = option.rect.adjusted(0, 0, -1, -1)
+        painter.setPen(option.palette.mid().color())
+        painter.drawRect(frame)
+
+        x = option.rect.left() + self.PADDING
+        y = option.rect.top() + self.PADDING
+        painter.setPen(option.palette.text().color())
+        painter.setFont(self._role_font(option))
+        painter.drawText(QRect(x, y, self._text_width(), role_height), Qt.AlignLeft, msg["role"].capitalize())
+        y += role_height
+
+        if static_text:
+            # Glyph layout was done once in _layout; this only blits it
+            y += self.SPACING
+            painter.setFont(option.font)
+            painter.drawStaticText(x, y, static_text)
+            y += round(static_text.size().height())
+
+        if image_size:
+            y += self.SPACING
+            pixmap = self._pixmap(msg["image"], image_size)
+            painter.drawPixmap(x, y, pixmap)
+        elif is_video_message(msg):
+            # Stand-in until MainWindow gives the row its player widget
+            y += self.SPACING
+            video_rect = QRect(x, y, 400, self.VIDEO_HEIGHT - self.SPACING)
+            painter.fillRect(video_rect, Qt.black)
+            still = video_still(msg["image"])
+            if still is not None and not still.isNull():
+                painter.drawPixmap(x + (video_rect.width() - still.width()) // 2, y, still)
             else:
-                img_label = QLabel()
-                pixmap = QPixmap(image_path)
-                # Scale if too large
-                if pixmap.width() > 512:
-                    pixmap = pixmap.scaledToWidth(512, Qt.SmoothTransformation)
-                img_label.setPixmap(pixmap)
-                self.layout.addWidget(img_label)
+                painter.setPen(Qt.gray)
+                painter.drawText(video_rect, Qt.AlignCenter, "Video")
+        painter.restore()
+
+    def _pixmap_source(self, image_path):
+        if image_path not in self._pixmap_keys:
+            self._pixmap_keys[image_path] = pixmap_source(image_path, self.IMAGE_WIDTH)
+        return self._pixmap_keys[image_path]
+
+    def add_preview(self, image_path, image):
+        # Seeds the caches with an image decoded by the generation worker, so a new
+        # message is shown without reading the file again on the UI thread
+        if image is None or image.isNull():
+            return
+        self._image_sizes[image_path] = image.size()
+        _, key = self._pixmap_source(image_path)
+        QPixmapCache.insert(key, QPixmap.fromImage(image))
+
+    def _pixmap(self, image_path, size):
+        source, key = self._pixmap_source(image_path)
+        pixmap = QPixmapCache.find(key)
+        if pixmap is None:
+            if source == image_path and QImageReader(source).size().width() > size.width():
+                # No thumbnail: show a fast scale now, replace it with a smooth one
+                # once the event loop is idle
+                pixmap = load_scaled_pixmap(source, size, Qt.FastTransformation)
+                QTimer.singleShot(0, lambda: self._smooth_rescale(source, key, size))
+            else:
+                pixmap = load_scaled_pixmap(source, size)
+            QPixmapCache.insert(key, pixmap)
+        return pixmap
+
+    def schedule_prefetch(self, *args):
+        # Slot for signals with differing arguments; QTimer.start(int) would take
+        # the first one as an interval
+        self.prefetch_timer.start()
+
+    def prefetch(self):
+        # Queue decodes for image rows within PREFETCH_MARGIN of the viewport
+        model = self.view.model()
+        height = self.view.viewport().height()
+        for row in range(first_row_below(self.view, -self.PREFETCH_MARGIN), model.rowCount()):
+            index = model.index(row)
+            if self.view.visualRect(index).top() > height + self.PREFETCH_MARGIN:
+                break
+            msg = model.message(index)
+            if self.view.indexWidget(index) or not msg.get("image"):
+                continue
+            size = self._image_size(msg["image"])
+            if not size:
+                continue
+            source, key = self._pixmap_source(msg["image"])
+            if key not in self._prefetching and QPixmapCache.find(key) is None:
+                self._prefetching.add(key)
+                QThreadPool.globalInstance().start(PreviewLoader(source, key, size, self.preview_signals))
+
+    def on_preview_loaded(self, key, image):
+        self._prefetching.discard(key)
+        if not image.isNull() and QPixmapCache.find(key) is None:
+            QPixmapCache.insert(key, QPixmap.fromImage(image))
+            self.view.viewport().update()
+
+    def _smooth_rescale(self, source, key, size):
+        pixmap = load_scaled_pixmap(source, size)
+        QPixmapCache.insert(key, pixmap)
+        self.view.viewport().update()
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -150,7 +741,23 @@ class MainWindow(QMainWindow):
         self.resize(1000, 800)
         
         self.current_convo_id = None
-        self.worker = None
+        # Generations run on their own pool so history loads never queue behind them
+        self.gen_pool = QThreadPool(self)
+        self.gen_pool.setMaxThreadCount(GENERATION_THREADS)
+        self.async_runner = AsyncRunner(IMAGE_CONCURRENCY)
+        self.async_runner.start()
+        self.active_workers = set()
+        self.message_pool = [] # detached ChatMessage widgets for reuse
+        self._history_cache = OrderedDict() # convo_id -> loaded history, least recently opened first
+        self._loading = {} # convo_id -> messages recorded while its history is being read
+        self._item_by_id = {}
+        self._scroll_pending = False
+        self.history_signals = HistorySignals()
+        self.history_signals.loaded.connect(self.on_history_loaded)
+        self.history_signals.older_loaded.connect(self.on_older_loaded)
+        self._pending_icons = {} # QPixmapCache key -> base image items waiting for that icon
+        self.icon_signals = PreviewSignals()
+        self.icon_signals.loaded.connect(self.on_icon_loaded)
         # self.uploaded_base_images removed in favor of UI list source of truth
 
         # Main Layout
@@ -187,14 +794,45 @@ class MainWindow(QMainWindow):
         right_layout = QVBoxLayout(right_panel)
         right_layout.setContentsMargins(0, 0, 0, 0)
         
-        # Chat History Scroll Area
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.chat_widget = QWidget()
-        self.chat_layout = QVBoxLayout(self.chat_widget)
-        self.chat_layout.setAlignment(Qt.AlignTop)
-        self.scroll_area.setWidget(self.chat_widget)
-        right_layout.addWidget(self.scroll_area)
+        # Chat History View
+        self.chat_model = ChatModel(self)
+        self.chat_view = QListView()
+        self.chat_view.setModel(self.chat_model)
+        self.chat_delegate = ChatDelegate(self.chat_view)
+        self.chat_view.setItemDelegate(self.chat_delegate)
+        self.chat_view.setUniformItemSizes(False)
+        self.chat_view.setResizeMode(QListView.Adjust)
+        self.chat_view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.chat_view.setSelectionMode(QAbstractItemView.NoSelection)
+        self.chat_view.setSpacing(3)
+        self.chat_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        right_layout.addWidget(self.chat_view)
+
+        # Video rows only get a player widget while they are near the viewport
+        self.widget_rows = [] # persistent indexes of the rows holding a ChatMessage
+        self.widget_timer = QTimer(self)
+        self.widget_timer.setSingleShot(True)
+        self.widget_timer.setInterval(50)
+        self.widget_timer.timeout.connect(self.sync_message_widgets)
+        self.chat_view.verticalScrollBar().valueChanged.connect(self.schedule_widget_sync)
+        self.chat_view.verticalScrollBar().rangeChanged.connect(self.schedule_widget_sync)
+        self.chat_model.modelReset.connect(self.schedule_widget_sync)
+        self.chat_model.rowsInserted.connect(self.schedule_widget_sync)
+
+        # Older history is fetched a page at a time when the view is scrolled to the
+        # top, debounced so dragging the scrollbar doesn't fire a query per step
+        self.older_placeholder = None
+        self.older_timer = QTimer(self)
+        self.older_timer.setSingleShot(True)
+        self.older_timer.setInterval(150)
+        self.older_timer.timeout.connect(self.load_older_messages)
+        scrollbar = self.chat_view.verticalScrollBar()
+        scrollbar.valueChanged.connect(self.on_chat_scrolled)
+        scrollbar.sliderReleased.connect(self.on_chat_scrolled)
+        # While the view is at the bottom it stays there when the content height
+        # changes (rows laid out late, text re-wrapped after a resize)
+        self._follow_bottom = True
+        scrollbar.rangeChanged.connect(self.on_chat_range_changed)
         
         # Cost Display
         self.cost_label = QLabel("Cost: $0.00")
@@ -250,7 +888,7 @@ class MainWindow(QMainWindow):
         
         self.base_image_list = QListWidget()
         self.base_image_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
-        self.base_image_list.setIconSize(QSize(64, 64))
+        self.base_image_list.setIconSize(QSize(BASE_ICON_SIZE, BASE_ICON_SIZE))
         self.base_image_list.setFixedHeight(100) # Give it some height
         self.base_image_list.setViewMode(QListWidget.IconMode)
         self.base_image_list.setResizeMode(QListWidget.Adjust)
@@ -305,13 +943,37 @@ class MainWindow(QMainWindow):
             self.upload_base_btn.setEnabled(True)
 
     def refresh_conversation_list(self):
-        self.convo_list.clear()
+        # Update the sidebar in place against the header rows: only new, moved,
+        # changed or deleted conversations touch the list widget
         conversations = storage.load_conversations()
-        for convo in conversations:
-            item = QListWidgetItem(convo.get("title", "Untitled"))
-            item.setData(Qt.UserRole, convo["id"])
-            item.setToolTip(f"Created: {convo.get('created_at')} \nCost: ${convo.get('total_cost', 0.0):.2f}")
-            self.convo_list.addItem(item)
+        seen = set()
+        for row, convo in enumerate(conversations):
+            convo_id = convo["id"]
+            seen.add(convo_id)
+            item = self._item_by_id.get(convo_id)
+            if item is None:
+                item = QListWidgetItem()
+                item.setData(Qt.UserRole, convo_id)
+                item.setData(Qt.UserRole + 1, convo.get("created_at"))
+                self._item_by_id[convo_id] = item
+                self.convo_list.insertItem(row, item)
+            elif self.convo_list.row(item) != row:
+                self.convo_list.insertItem(row, self.convo_list.takeItem(self.convo_list.row(item)))
+
+            title = convo.get("title", "Untitled")
+            if item.text() != title:
+                item.setText(title)
+            total_cost = convo.get("total_cost") or 0.0
+            if item.data(Qt.UserRole + 2) != total_cost:
+                self.set_item_cost(item, total_cost)
+
+        for convo_id in [convo_id for convo_id in self._item_by_id if convo_id not in seen]:
+            item = self._item_by_id.pop(convo_id)
+            self.convo_list.takeItem(self.convo_list.row(item))
+
+    def set_item_cost(self, item, total_cost):
+        item.setData(Qt.UserRole + 2, total_cost)
+        item.setToolTip(f"Created: {item.data(Qt.UserRole + 1)} \nCost: ${total_cost:.2f}")
 
     def start_new_conversation(self):
         self.current_convo_id = storage.create_conversation()
@@ -328,27 +990,215 @@ class MainWindow(QMainWindow):
         convo_id = item.data(Qt.UserRole)
         self.current_convo_id = convo_id
         
-        # Clear chat area
-        for i in reversed(range(self.chat_layout.count())): 
-            self.chat_layout.itemAt(i).widget().setParent(None)
-            
-        data = storage.load_history(convo_id)
+        if convo_id in self._history_cache:
+            self._history_cache.move_to_end(convo_id)
+            self.show_history(self._history_cache[convo_id])
+        else:
+            # Don't leave the previous conversation's rows up while this one loads;
+            # anything recorded meanwhile is shown on its own until the history arrives
+            self.show_history(None)
+            self.cost_label.setText(f"Total Cost: ${item.data(Qt.UserRole + 2) or 0.0:.2f}")
+            self.start_history_load(convo_id)
+
+    def start_history_load(self, convo_id):
+        if convo_id not in self._loading:
+            self._loading[convo_id] = 0
+            QThreadPool.globalInstance().start(HistoryLoader(convo_id, self.history_signals))
+
+    def on_history_loaded(self, convo_id, data, media):
+        if self._loading.pop(convo_id, 0):
+            # Messages were recorded while this was read and may be missing from it;
+            # read again, after they have been flushed
+            self.start_history_load(convo_id)
+            return
+        if data:
+            self.cache_history(convo_id, data)
+            item = self._item_by_id.get(convo_id)
+            if item is not None and item.text() != data.get("title"):
+                item.setText(data.get("title"))
+        # Ignore results for a conversation the user has already left
+        if convo_id == self.current_convo_id:
+            self.show_history(data, media)
+
+    def cache_history(self, convo_id, data):
+        # Memory stays bounded however many conversations are opened; an evicted
+        # one is read back a page at a time from storage on its next visit
+        self._history_cache[convo_id] = data
+        self._history_cache.move_to_end(convo_id)
+        while len(self._history_cache) > HISTORY_CACHE_SIZE:
+            self._history_cache.popitem(last=False)
+
+    def show_history(self, data, media=None):
+        self.older_placeholder = None
+        self.release_message_widgets()
         if not data:
+            self.chat_delegate.clear_cache()
+            self.chat_model.set_messages([])
             return
 
         # Update running cost label
         total_cost = data.get("total_cost", 0.0)
         self.cost_label.setText(f"Total Cost: ${total_cost:.2f}")
 
-        for msg in data.get("history", []):
-            self.add_message_to_ui(msg["role"], msg.get("text"), msg.get("image"))
+        # Replacing the model contents also drops any per-row widgets and a pending
+        # "loading older" row; video widgets are attached again by sync_message_widgets
+        self.chat_delegate.clear_cache()
+        if media:
+            self.chat_delegate.seed(media)
+        self.chat_model.set_messages(data.get("history", []))
+        self.scroll_to_bottom()
+
+    def on_chat_range_changed(self, minimum, maximum):
+        if self._follow_bottom:
+            self.chat_view.verticalScrollBar().setValue(maximum)
+
+    def on_chat_scrolled(self):
+        scrollbar = self.chat_view.verticalScrollBar()
+        self._follow_bottom = scrollbar.value() == scrollbar.maximum()
+        if scrollbar.value() == 0:
+            self.older_timer.start()
+
+    def load_older_messages(self):
+        scrollbar = self.chat_view.verticalScrollBar()
+        if scrollbar.value() != 0 or scrollbar.isSliderDown() or self.older_placeholder:
+            return
+        messages = self.chat_model.messages
+        oldest = messages[0].get("position") if messages else None
+        if not oldest:
+            return # nothing loaded yet, or already at the first message
+
+        self.older_placeholder = {"role": "system", "text": "Loading older messages..."}
+        self.chat_model.prepend_messages([self.older_placeholder])
+        QThreadPool.globalInstance().start(HistoryLoader(self.current_convo_id, self.history_signals, oldest))
+
+    def on_older_loaded(self, convo_id, msgs, media):
+        data = self._history_cache.get(convo_id)
+        if msgs and data is not None and data["history"] and data["history"][0].get("position", 0) > msgs[-1]["position"]:
+            data["history"][:0] = msgs
+        if convo_id != self.current_convo_id or self.older_placeholder is None:
+            return
+
+        # Keep the rows that were on screen in place while rows are added above them
+        scrollbar = self.chat_view.verticalScrollBar()
+        from_bottom = scrollbar.maximum() - scrollbar.value()
+        self.chat_view.setUpdatesEnabled(False)
+        self.chat_delegate.forget(self.chat_model.remove_first())
+        self.older_placeholder = None
+        self.chat_delegate.seed(media)
+        if msgs:
+            self.chat_model.prepend_messages(msgs)
+        self.chat_view.doItemsLayout()
+        scrollbar.setValue(scrollbar.maximum() - from_bottom)
+        self.chat_view.setUpdatesEnabled(True)
+
+    def schedule_widget_sync(self, *args):
+        self.widget_timer.start()
+
+    def sync_message_widgets(self):
+        # Gives video rows within VIDEO_WIDGET_MARGIN of the viewport a player
+        # widget and hands the widgets of rows further away back to the pool
+        height = self.chat_view.viewport().height()
+        messages = self.chat_model.messages
+        near = []
+        for row in range(first_row_below(self.chat_view, -VIDEO_WIDGET_MARGIN), len(messages)):
+            if self.chat_view.visualRect(self.chat_model.index(row)).top() > height + VIDEO_WIDGET_MARGIN:
+                break
+            if is_video_message(messages[row]):
+                near.append(row)
+        # Far rows go back to the pool first, so the attaches below can reuse them
+        for index in list(self.widget_rows):
+            if not index.isValid():
+                self.widget_rows.remove(index)
+            elif index.row() not in near:
+                self.detach_message_widget(index.row())
+        for row in near:
+            if self.chat_view.indexWidget(self.chat_model.index(row)) is None:
+                self.attach_message_widget(row, messages[row])
+
+    def attach_message_widget(self, row, msg):
+        # Videos need a real player widget; other rows are painted by the delegate.
+        # The view deletes index widgets when rows go away, so each row gets a
+        # throwaway slot holding a pooled ChatMessage.
+        if self.message_pool:
+            widget = self.message_pool.pop()
+            widget.reset(msg["role"], msg.get("text"), msg.get("image"))
+        else:
+            widget = ChatMessage(msg["role"], msg.get("text"), msg.get("image"))
+        slot = QWidget()
+        slot_layout = QVBoxLayout(slot)
+        slot_layout.setContentsMargins(0, 0, 0, 0)
+        slot_layout.addWidget(widget)
+        widget.show()
+        self.chat_view.setIndexWidget(self.chat_model.index(row), slot)
+        self.widget_rows.append(QPersistentModelIndex(self.chat_model.index(row)))
+
+    def detach_message_widget(self, row):
+        # Takes the row's ChatMessage out of its slot and back to the pool
+        index = self.chat_model.index(row)
+        slot = self.chat_view.indexWidget(index)
+        if slot is None:
+            return
+        if slot.layout().count():
+            widget = slot.layout().itemAt(0).widget()
+            widget.release()
+            widget.setParent(None)
+            self.message_pool.append(widget)
+        self.chat_view.setIndexWidget(index, None)
+        self.widget_rows.remove(QPersistentModelIndex(index))
+
+    def release_message_widgets(self):
+        # Pools every ChatMessage before the model drops the rows
+        for index in list(self.widget_rows):
+            if index.isValid():
+                self.detach_message_widget(index.row())
+        self.widget_rows = []
+
+    def record_message(self, role, text, image_path=None, cost=0.0, convo_id=None):
+        # Queue a message for the storage writer, keep the cached history and the
+        # sidebar item in step, and show it if its conversation is open. Returns the
+        # conversation's new total cost, tracked here so nothing waits on the write.
+        convo_id = convo_id or self.current_convo_id
+        is_current = convo_id == self.current_convo_id
+        # While the history is loading the model doesn't show whether this is the
+        # first message; on_history_loaded takes the title from storage instead
+        is_first = is_current and convo_id not in self._loading and not self.chat_model.messages
+        if convo_id in self._loading:
+            self._loading[convo_id] += 1
+        storage.queue_message(convo_id, role, text, image_path, cost=cost)
+        item = self._item_by_id.get(convo_id)
+        data = self._history_cache.get(convo_id)
+        if item is not None:
+            total_cost = item.data(Qt.UserRole + 2) + cost
+        elif data is not None:
+            total_cost = data.get("total_cost", 0.0) + cost
+        else:
+            total_cost = cost
+        if data is not None:
+            data["history"].append({"role": role, "text": text, "image": image_path, "cost": cost})
+            data["total_cost"] = total_cost
+        if is_current:
+            self.add_message_to_ui(role, text, image_path)
+
+        if item is not None:
+            self.set_item_cost(item, total_cost)
+            if is_first and role == "user" and item.text() == "New Conversation":
+                item.setText(storage.title_from_prompt(text))
+        return total_cost
 
     def add_message_to_ui(self, role, text, image_path=None):
-        msg_widget = ChatMessage(role, text, image_path)
-        self.chat_layout.addWidget(msg_widget)
-        # Scroll to bottom
-        QApplication.processEvents()
-        self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum())
+        msg = {"role": role, "text": text, "image": image_path}
+        self.chat_model.append_message(msg)
+        self.scroll_to_bottom()
+
+    def scroll_to_bottom(self):
+        # Coalesce bursts of messages into a single scroll on the next event loop pass
+        if not self._scroll_pending:
+            self._scroll_pending = True
+            QTimer.singleShot(0, self._scroll_to_bottom)
+
+    def _scroll_to_bottom(self):
+        self._scroll_pending = False
+        self.chat_view.scrollToBottom()
 
     def upload_base_image(self):
         # Allow multiple selection
@@ -356,23 +1206,43 @@ class MainWindow(QMainWindow):
         if file_paths:
             for file_path in file_paths:
                 try:
-                    # Verify we can open it
-                    img = Image.open(file_path)
+                    # Verify we can open it; only the header is read
+                    reader = QImageReader(file_path)
+                    if not reader.canRead():
+                        raise ValueError(reader.errorString())
                     # Create Item
                     item = QListWidgetItem(os.path.basename(file_path))
                     item.setData(Qt.UserRole, file_path)
                     item.setToolTip(file_path)
                     
-                    # Create Thumbnail
-                    pixmap = QPixmap(file_path)
-                    if not pixmap.isNull():
-                         pixmap = pixmap.scaled(64, 64, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                         item.setIcon(QIcon(pixmap))
+                    # Create Thumbnail, shared through QPixmapCache with any earlier
+                    # upload of the same file (chat images keep their own width key).
+                    # Uncached ones are decoded on the thread pool so selecting many
+                    # large files doesn't hold up the UI.
+                    source, key = pixmap_source(file_path, BASE_ICON_SIZE)
+                    pixmap = QPixmapCache.find(key)
+                    if pixmap is not None:
+                        item.setIcon(QIcon(pixmap))
+                    elif key in self._pending_icons:
+                        self._pending_icons[key].append(item)
+                    else:
+                        self._pending_icons[key] = [item]
+                        QThreadPool.globalInstance().start(
+                            PreviewLoader(source, key, QSize(BASE_ICON_SIZE, BASE_ICON_SIZE), self.icon_signals))
                     
                     self.base_image_list.addItem(item)
                 except Exception as e:
                     QMessageBox.warning(self, "Error", f"Failed to load {file_path}: {e}")
 
+    def on_icon_loaded(self, key, image):
+        items = self._pending_icons.pop(key, [])
+        if image.isNull():
+            return
+        pixmap = QPixmap.fromImage(image)
+        QPixmapCache.insert(key, pixmap)
+        for item in items:
+            item.setIcon(QIcon(pixmap))
+
     def remove_base_image(self):
         selected_items = self.base_image_list.selectedItems()
         if not selected_items:
@@ -397,119 +1267,70 @@ class MainWindow(QMainWindow):
             elif video_mode_ui == "Bring to Life": video_mode_key = 'bring_to_life'
             elif video_mode_ui == "Reference": video_mode_key = 'reference'
 
-        self.gen_btn.setEnabled(False)
-        self.prompt_input.setDisabled(True)
-        self.use_base_checkbox.setDisabled(True)
-        self.upload_base_btn.setDisabled(True)
-        self.remove_base_btn.setDisabled(True)
-        self.base_image_list.setDisabled(True)
-        # UI state for buttons handled by update_ui_state generally, but disable during gen
-        
         # Save User Message
-        storage.save_message(self.current_convo_id, "user", prompt)
-        self.add_message_to_ui("user", prompt)
+        self.record_message("user", prompt)
         
         # Determine output path
         if is_video:
              # Basic timestamp filename for video
-             output_path = os.path.join(storage.get_conversation_dir(self.current_convo_id), f"vid_{int(time.time())}.mp4")
+             output_path = os.path.join(storage.get_conversation_dir(self.current_convo_id), f"vid_{int(time.time() * 1000)}.mp4")
         else:
              output_path = storage.get_image_save_path(self.current_convo_id)
         
-        # Determine base images from ListWidget
-        base_images = []
-        
+        # Determine base images; the worker opens them off the UI thread
         # 1. From List Widget
-        for i in range(self.base_image_list.count()):
-            item = self.base_image_list.item(i)
-            file_path = item.data(Qt.UserRole)
-            try:
-                img = Image.open(file_path)
-                base_images.append(img)
-            except Exception as e:
-                print(f"Failed to load base image {file_path}: {e}")
-
-        # 2. Logic for "Use Last Image" (Append to list if checked)
-        if self.use_base_checkbox.isChecked() and self.use_base_checkbox.isEnabled():
-             data = storage.load_history(self.current_convo_id)
-             if data and "history" in data:
-                 for msg in reversed(data["history"]):
-                     if msg.get("image") and msg["image"].endswith(('.png', '.jpg', '.jpeg')):
-                         try:
-                             base_images.append(Image.open(msg["image"]))
-                             # Note: This doesn't add it to the visual list, just for this generation.
-                             # If we wanted to be explicit, we could add it to the list, but "use last" feels ephemeral.
-                             # Keeping it ephemeral for now as per previous logic.
-                             break
-                         except:
-                             pass
-        
-        # Worker Setup
-        self.signals = WorkerSignals()
-        self.signals.finished.connect(self.on_generation_finished)
-        self.signals.error.connect(self.on_generation_error)
-        
-        self.worker = GenerationWorker(prompt, output_path, base_images, video_mode_key, self.signals)
-        self.worker.start()
+        base_images = [self.base_image_list.item(i).data(Qt.UserRole) for i in range(self.base_image_list.count())]
 
-    def on_generation_finished(self, output_path, message):
-        # output_path comes from worker (image_obj or path)
-        # If it's a string path, assume it's saved.
-        # If it's an image object (legacy code returned result as PIL image sometimes? No, generate_image_content returned path in previous code? 
-        # Wait, previous generate_image_content returned image object OR None. 
-        # I changed generate_video_content to return path.
-        # I should check generate_images.generate_image_content behavior. 
-        # It returns saved_img (PIL Image).
-        # So I need to handle both.
+        # 2. "Use Last Image" is looked up by the worker. It doesn't add it to the
+        # visual list, just for this generation.
+        use_last_image = self.use_base_checkbox.isChecked() and self.use_base_checkbox.isEnabled()
         
-        is_video = isinstance(output_path, str) and output_path.endswith(".mp4")
+        # Worker Setup. Inputs stay usable while generations run; Generate is only
+        # disabled once enough of them are pending.
+        worker = GenerationWorker(prompt, output_path, base_images, video_mode_key,
+                                  convo_id=self.current_convo_id, use_last_image=use_last_image)
+        # Queued explicitly: these are always emitted from a pool thread
+        worker.signals.finished.connect(self.on_generation_finished, Qt.QueuedConnection)
+        worker.signals.error.connect(self.on_generation_error, Qt.QueuedConnection)
+        self.active_workers.add(worker)
+        if video_mode_key:
+            self.gen_pool.start(worker)
+        else:
+            self.async_runner.submit(worker.run_async(self.async_runner.sem))
+        self.update_generate_button()
+
+    def update_generate_button(self):
+        self.gen_btn.setEnabled(len(self.active_workers) < MAX_PENDING_GENERATIONS)
+
+    def finish_worker(self, worker):
+        self.active_workers.discard(worker)
+        self.update_generate_button()
+
+    def on_generation_finished(self, worker, output_path, message):
+        # output_path is the worker's result; both image and video generation return the saved path
+        is_video = isinstance(output_path, str) and is_video_path(output_path)
         
         if is_video:
             msg_text = "Video Generated"
             cost = COST_PER_IMAGE * 10
-            # output_path is the path
         else:
-             # Logic for image object
-             # The old code was: 
-             # self.worker.output_path was used. 
-             # generate_image_content returned result (PIL Image) if success.
-             # But on_generation_finished(self, image_obj, message).
-             # It ignored image_obj and used self.worker.output_path for saving message.
-             # So I can just use self.worker.output_path.
-             
-             msg_text = "Image Generated"
-             cost = COST_PER_IMAGE
-        
-        saved_path = self.worker.output_path
-        
-        # Save Assistant Message with Image/Video
-        storage.save_message(self.current_convo_id, "assistant", msg_text, saved_path, cost=cost)
-        self.add_message_to_ui("assistant", msg_text, saved_path)
+            msg_text = "Image Generated"
+            cost = COST_PER_IMAGE
+        
+        self.finish_worker(worker)
+        self.chat_delegate.add_preview(output_path, worker.preview)
+        
+        # Save Assistant Message with Image/Video, in the conversation it was asked in
+        total_cost = self.record_message("assistant", msg_text, output_path, cost=cost, convo_id=worker.convo_id)
         
         # Update cost
-        data = storage.load_history(self.current_convo_id)
-        total_cost = data.get("total_cost", 0.0)
-        self.cost_label.setText(f"Total Cost: ${total_cost:.2f}")
+        if worker.convo_id == self.current_convo_id:
+            self.cost_label.setText(f"Total Cost: ${total_cost:.2f}")
 
-        self.gen_btn.setEnabled(True)
-        self.prompt_input.setDisabled(False)
-        self.use_base_checkbox.setDisabled(False)
-        self.upload_base_btn.setDisabled(False)
-        self.remove_base_btn.setDisabled(False)
-        self.base_image_list.setDisabled(False)
-        self.refresh_conversation_list() # To update tooltip costs
-
-    def on_generation_error(self, error_msg):
+    def on_generation_error(self, worker, error_msg):
+        self.finish_worker(worker)
+        self.record_message("assistant", f"Error: {error_msg}", convo_id=worker.convo_id)
         QMessageBox.critical(self, "Error", error_msg)
-        storage.save_message(self.current_convo_id, "assistant", f"Error: {error_msg}")
-        self.add_message_to_ui("assistant", f"Error: {error_msg}")
-        
-        self.gen_btn.setEnabled(True)
-        self.prompt_input.setDisabled(False)
-        self.use_base_checkbox.setDisabled(False)
-        self.upload_base_btn.setDisabled(False)
-        self.remove_base_btn.setDisabled(False)
-        self.base_image_list.setDisabled(False)
 
     def open_settings(self):
         dialog = SettingsDialog(self)
@@ -517,35 +1338,16 @@ class MainWindow(QMainWindow):
             new_key = dialog.get_api_key()
             # Update .env
             try:
-                env_path = os.path.join(os.getcwd(), ".env")
-                lines = []
-                if os.path.exists(env_path):
-                    with open(env_path, "r") as f:
-                        lines = f.readlines()
-                
-                key_found = False
-                for i, line in enumerate(lines):
-                    if line.startswith("GOOGLE_API_KEY=") or line.startswith("GEMINI_API_KEY="):
-                        lines[i] = f"GOOGLE_API_KEY={new_key}\n"
-                        key_found = True
-                        break
-                
-                if not key_found:
-                    lines.append(f"\nGOOGLE_API_KEY={new_key}\n")
-                
-                with open(env_path, "w") as f:
-                    f.writelines(lines)
-                
-                # Reload module (hacky but works for simple case) or just re-init client
+                set_env_value(os.path.join(os.getcwd(), ".env"), "GOOGLE_API_KEY", new_key)
                 os.environ["GOOGLE_API_KEY"] = new_key
-                import importlib
-                importlib.reload(generate_images)
-                
+                generate_images.reinit_client(new_key)
             except Exception as e:
                 QMessageBox.warning(self, "Error Saving Settings", str(e))
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    QPixmapCache.setCacheLimit(262144) # KB; keeps several conversations' images decoded across switches
+    app.aboutToQuit.connect(storage.close)
     window = MainWindow()
     window.show()
     sys.exit(app.exec())
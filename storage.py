@@ -1,15 +1,113 @@
 import os
-import json
 import uuid
 import time
+import queue
+import shutil
+import subprocess
+import atexit
+import sqlite3
+import threading
 from datetime import datetime
+from PIL import Image
+from generate_images import atomic_output, json_loads
 
 CONVERSATIONS_DIR = "conversations"
+DB_PATH = os.path.join(CONVERSATIONS_DIR, "conversations.db")
+THUMB_WIDTH = 512
+ICON_WIDTH = 64
+THUMB_QUALITY = 85
+HISTORY_PAGE_SIZE = 30
+WRITE_DEBOUNCE = 0.25 # seconds of quiet before the writer commits a burst
+WRITE_MAX_DELAY = 1.0 # ...but never hold a message longer than this
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    total_cost REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    convo_id TEXT NOT NULL REFERENCES conversations(id),
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    text TEXT,
+    image_path TEXT,
+    timestamp TEXT,
+    cost REAL NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_msgs ON messages(convo_id, position);
+CREATE INDEX IF NOT EXISTS idx_convos_created ON conversations(created_at);
+"""
+
+# One connection per thread (history is also read from the GUI's thread pool);
+# WAL lets those readers run alongside a write.
+local = threading.local()
+schema_lock = threading.Lock()
+schema_ready = False
+
+# Messages queued from the GUI, written by a single background thread
+write_queue = queue.Queue()
+writer_lock = threading.Lock()
+writer_thread = None
 
 def ensure_conversations_dir():
     if not os.path.exists(CONVERSATIONS_DIR):
         os.makedirs(CONVERSATIONS_DIR)
 
+def get_connection():
+    global schema_ready
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        ensure_conversations_dir()
+        conn = sqlite3.connect(DB_PATH, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-65536") # 64 MB
+        conn.execute("PRAGMA temp_store=MEMORY")
+        with schema_lock:
+            if not schema_ready:
+                conn.executescript(SCHEMA)
+                migrate_json_histories(conn)
+                schema_ready = True
+        local.conn = conn
+    return conn
+
+def close():
+    # Call at shutdown: writes anything still queued and lets SQLite refresh its
+    # query planner statistics
+    flush()
+    conn = getattr(local, "conn", None)
+    if conn is not None:
+        conn.execute("PRAGMA optimize")
+        conn.close()
+        local.conn = None
+
+def migrate_json_histories(conn):
+    # Import conversations still stored as <id>/history.json. The JSON files are
+    # left in place; conversations already in the database are skipped.
+    known = {row["id"] for row in conn.execute("SELECT id FROM conversations")}
+    for name in os.listdir(CONVERSATIONS_DIR):
+        history_file = os.path.join(CONVERSATIONS_DIR, name, "history.json")
+        if name in known or not os.path.exists(history_file):
+            continue
+        try:
+            with open(history_file, "rb") as f:
+                meta = json_loads(f.read())
+        except ValueError: # json.JSONDecodeError and orjson.JSONDecodeError both subclass it
+            continue
+        convo_id = meta.get("id", name)
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO conversations (id, title, created_at, total_cost) VALUES (?, ?, ?, ?)",
+                (convo_id, meta.get("title", "New Conversation"), meta.get("created_at", ""), meta.get("total_cost", 0.0)))
+            conn.executemany(
+                "INSERT OR IGNORE INTO messages (convo_id, position, role, text, image_path, timestamp, cost) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(convo_id, i, m.get("role"), m.get("text"), m.get("image"), m.get("timestamp"), m.get("cost", 0.0))
+                 for i, m in enumerate(meta.get("history", []))])
+        print(f"Migrated conversation {convo_id} to {DB_PATH}")
+
 def create_conversation(title=None):
     ensure_conversations_dir()
     convo_id = str(uuid.uuid4())
@@ -17,77 +115,207 @@ def create_conversation(title=None):
     os.makedirs(convo_dir)
     os.makedirs(os.path.join(convo_dir, "images"))
     
-    metadata = {
-        "id": convo_id,
-        "title": title or "New Conversation",
-        "created_at": datetime.now().isoformat(),
-        "total_cost": 0.0,
-        "history": []
-    }
-    
-    with open(os.path.join(convo_dir, "history.json"), "w") as f:
-        json.dump(metadata, f, indent=4)
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO conversations (id, title, created_at, total_cost) VALUES (?, ?, ?, 0)",
+            (convo_id, title or "New Conversation", datetime.now().isoformat()))
         
     return convo_id
 
-def save_message(convo_id, role, text, image_path=None, cost=0.0):
-    convo_dir = os.path.join(CONVERSATIONS_DIR, convo_id)
-    history_file = os.path.join(convo_dir, "history.json")
-    
-    if not os.path.exists(history_file):
+def title_from_prompt(text):
+    # Title given to a "New Conversation" by its first user message
+    return text[:30] + "..." if len(text) > 30 else text
+
+def insert_message(conn, convo_id, role, text, image_path, cost, timestamp):
+    # Adds a message inside the caller's transaction
+    convo = conn.execute("SELECT title FROM conversations WHERE id = ?", (convo_id,)).fetchone()
+    if convo is None:
         print(f"Error: Conversation {convo_id} not found.")
         return
 
-    with open(history_file, "r") as f:
-        metadata = json.load(f)
-    
-    message = {
-        "role": role,
-        "text": text,
-        "timestamp": datetime.now().isoformat(),
-        "image": image_path,
-        "cost": cost
-    }
-    
-    metadata["history"].append(message)
-    metadata["total_cost"] = metadata.get("total_cost", 0.0) + cost
+    position = conn.execute(
+        "SELECT COALESCE(MAX(position) + 1, 0) FROM messages WHERE convo_id = ?", (convo_id,)).fetchone()[0]
+    conn.execute(
+        "INSERT INTO messages (convo_id, position, role, text, image_path, timestamp, cost) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (convo_id, position, role, text, image_path, timestamp, cost))
+    conn.execute("UPDATE conversations SET total_cost = total_cost + ? WHERE id = ?", (cost, convo_id))
     # Update title if it's the first user message and title is default
-    if role == "user" and len(metadata["history"]) == 1 and metadata["title"] == "New Conversation":
-        metadata["title"] = text[:30] + "..." if len(text) > 30 else text
+    if role == "user" and position == 0 and convo["title"] == "New Conversation":
+        conn.execute("UPDATE conversations SET title = ? WHERE id = ?", (title_from_prompt(text), convo_id))
 
-    with open(history_file, "w") as f:
-        json.dump(metadata, f, indent=4)
+def queue_message(convo_id, role, text, image_path=None, cost=0.0):
+    # Saves a message without blocking the GUI thread; the background writer
+    # commits it, together with anything else queued in the same burst
+    start_writer()
+    write_queue.put_nowait((convo_id, role, text, image_path, cost, datetime.now().isoformat()))
 
-def load_conversations():
-    ensure_conversations_dir()
-    conversations = []
-    for name in os.listdir(CONVERSATIONS_DIR):
-        path = os.path.join(CONVERSATIONS_DIR, name)
-        if os.path.isdir(path):
-            history_file = os.path.join(path, "history.json")
-            if os.path.exists(history_file):
+def start_writer():
+    global writer_thread
+    with writer_lock:
+        if writer_thread is None:
+            writer_thread = threading.Thread(target=writer_loop, name="storage-writer", daemon=True)
+            writer_thread.start()
+
+def writer_loop():
+    while True:
+        # Keep collecting until the queue has been quiet for WRITE_DEBOUNCE, so a
+        # burst is committed in one transaction. None is flush() asking for an
+        # immediate write.
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + WRITE_MAX_DELAY
+        while batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(write_queue.get(timeout=min(WRITE_DEBOUNCE, remaining)))
+            except queue.Empty:
+                break
+        messages = [message for message in batch if message is not None]
+        try:
+            if messages:
+                conn = get_connection()
+                conn.execute("BEGIN IMMEDIATE")
                 try:
-                    with open(history_file, "r") as f:
-                        meta = json.load(f)
-                        conversations.append(meta)
-                except json.JSONDecodeError:
-                    pass
-    
-    # Sort by created_at desc
-    conversations.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-    return conversations
+                    for message in messages:
+                        insert_message(conn, *message)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        except Exception as e:
+            print(f"Error saving {len(messages)} message(s): {e}")
+        finally:
+            for _ in batch:
+                write_queue.task_done()
+
+def flush():
+    # Blocks until every queued message is committed, cutting the writer's debounce
+    # short. Reads call this first so they always see what has been queued.
+    if writer_thread is not None:
+        write_queue.put_nowait(None)
+        write_queue.join()
+
+# Don't lose a pending burst when the process exits without calling close()
+atexit.register(flush)
+
+def load_conversations():
+    # Header rows only; no message is read to build the sidebar
+    flush()
+    rows = get_connection().execute(
+        "SELECT id, title, created_at, total_cost FROM conversations ORDER BY created_at DESC")
+    return [dict(row) for row in rows]
+
+def message_from_row(row):
+    return {"role": row["role"], "text": row["text"], "timestamp": row["timestamp"],
+            "image": row["image_path"], "cost": row["cost"], "position": row["position"]}
+
+def load_conversation_header(convo_id):
+    flush()
+    row = get_connection().execute(
+        "SELECT id, title, created_at, total_cost FROM conversations WHERE id = ?", (convo_id,)).fetchone()
+    return dict(row) if row else None
 
-def load_history(convo_id):
-    history_file = os.path.join(CONVERSATIONS_DIR, convo_id, "history.json")
-    if os.path.exists(history_file):
-        with open(history_file, "r") as f:
-            return json.load(f)
-    return None
+def load_history_page(convo_id, before_position=None, limit=HISTORY_PAGE_SIZE):
+    # The newest `limit` messages older than before_position (or the newest overall),
+    # returned oldest first
+    flush()
+    query = "SELECT role, text, timestamp, image_path, cost, position FROM messages WHERE convo_id = ?"
+    params = [convo_id]
+    if before_position is not None:
+        query += " AND position < ?"
+        params.append(before_position)
+    rows = get_connection().execute(query + " ORDER BY position DESC LIMIT ?", params + [limit]).fetchall()
+    return [message_from_row(row) for row in reversed(rows)]
+
+def load_history(convo_id, limit=HISTORY_PAGE_SIZE):
+    # Conversation header plus its newest page of messages
+    flush()
+    metadata = load_conversation_header(convo_id)
+    if metadata is None:
+        return None
+    metadata["history"] = load_history_page(convo_id, limit=limit)
+    return metadata
+
+IMAGE_EXTS = frozenset({".png", ".jpg", ".jpeg"})
+# LIKE is case-insensitive for ASCII, like the lower() comparisons elsewhere
+LAST_IMAGE_QUERY = (
+    "SELECT image_path FROM messages WHERE convo_id = ? AND ("
+    + " OR ".join(f"image_path LIKE '%{ext}'" for ext in sorted(IMAGE_EXTS))
+    + ") ORDER BY position DESC LIMIT 1")
+
+def last_image_path(convo_id):
+    # Most recent image (not video) in a conversation, including pages not loaded in the UI
+    flush()
+    row = get_connection().execute(LAST_IMAGE_QUERY, (convo_id,)).fetchone()
+    return row["image_path"] if row else None
 
 def get_image_save_path(convo_id, extension=".png"):
     timestamp = int(time.time() * 1000)
     filename = f"{timestamp}{extension}"
     return os.path.join(CONVERSATIONS_DIR, convo_id, "images", filename)
 
+def get_thumbnail_path(image_path, width=THUMB_WIDTH):
+    # conversations/<id>/thumbs/<name>_<width>.jpg for conversations/<id>/images/<name>.png;
+    # files outside an images dir get a thumbs dir of their own
+    image_dir, filename = os.path.split(image_path)
+    if os.path.basename(image_dir) == "images":
+        image_dir = os.path.dirname(image_dir)
+    name = os.path.splitext(filename)[0]
+    return os.path.join(image_dir, "thumbs", f"{name}_{width}.jpg")
+
+def save_thumbnail(img, thumb_path, width):
+    # Scales img in place to width (never up) and writes it as a JPEG. Only the
+    # width bounds the box, so a rounded-down height can't shave a pixel off it
+    if img.width > width:
+        img.thumbnail((width, img.height), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    with atomic_output(thumb_path) as tmp_path:
+        img.save(tmp_path, "JPEG", quality=THUMB_QUALITY)
+
+def make_thumbnails(image_path):
+    # Writes the display-sized (THUMB_WIDTH) and icon-sized (ICON_WIDTH) copies of a
+    # saved image, so the chat and the base image list only decode small JPEGs.
+    # Returns the display thumbnail's path, or None if the image is no wider than
+    # that or can't be read.
+    thumb_path = get_thumbnail_path(image_path)
+    try:
+        with Image.open(image_path) as img:
+            # Decided on the original width: draft() below may already shrink a
+            # JPEG to about THUMB_WIDTH
+            too_small = img.width <= THUMB_WIDTH
+            img.draft("RGB", (THUMB_WIDTH, max(1, THUMB_WIDTH * img.height // img.width)))
+            if too_small:
+                thumb_path = None
+            else:
+                save_thumbnail(img, thumb_path, THUMB_WIDTH)
+            # The icon is scaled down from the (already smaller) display copy
+            save_thumbnail(img, get_thumbnail_path(image_path, ICON_WIDTH), ICON_WIDTH)
+        return thumb_path
+    except (OSError, ValueError) as e:
+        print(f"Could not create thumbnails for {image_path}: {e}")
+        return None
+
+def make_video_thumbnail(video_path):
+    # Writes the video's first frame, THUMB_WIDTH wide, as its thumbnail so the chat
+    # can show a still without opening a media pipeline. Needs ffmpeg on PATH;
+    # returns the thumbnail path, or None if it couldn't be made.
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return None
+    thumb_path = get_thumbnail_path(video_path)
+    try:
+        with atomic_output(thumb_path) as tmp_path:
+            subprocess.run(
+                [ffmpeg, "-v", "error", "-y", "-i", video_path, "-frames:v", "1",
+                 "-vf", f"scale='min({THUMB_WIDTH},iw)':-2", "-q:v", "3", "-f", "image2", "-c:v", "mjpeg", tmp_path],
+                check=True, capture_output=True, timeout=30)
+        return thumb_path
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Could not create thumbnail for {video_path}: {e}")
+        return None
+
 def get_conversation_dir(convo_id):
     return os.path.join(CONVERSATIONS_DIR, convo_id)
@@ -42,34 +42,47 @@ new_tasks = [
   }
 ]
 
+DIRTY_SUFFIX = "-dirty"
+NO_PEOPLE_PREFIX = "ABSOLUTELY NO PEOPLE. EMPTY ROOM. "
+
 def update_tasks():
     with open(TASKS_FILE, 'r') as f:
         tasks = json.load(f)
+    changed = False
 
     # 1. Add missing tasks (check by clean_file to avoid dupes)
     existing_clean_files = {t['clean_file'] for t in tasks}
     for new_task in new_tasks:
         if new_task['clean_file'] not in existing_clean_files:
             tasks.append(new_task)
+            existing_clean_files.add(new_task['clean_file'])
+            changed = True
             print(f"Added new task for {new_task['clean_file']}")
 
     # 2. Update all tasks: rename dirty_file to v2 and enforce NO PEOPLE prompt
     for task in tasks:
         # Update filename
-        base_name = task['dirty_file'].rsplit('.', 1)[0]
-        ext = task['dirty_file'].rsplit('.', 1)[1]
+        base_name, ext = os.path.splitext(task['dirty_file'])
         
         # Remove old -v2 if exists to avoid -v2-v2
-        if base_name.endswith("-dirty"):
-             task['dirty_file'] = f"{base_name}-v2.{ext}"
-        elif "-dirty-" not in base_name: # Handle cases where it might not have -dirty suffix effectively
-             task['dirty_file'] = f"{base_name}-dirty-v2.{ext}"
+        if base_name.endswith(DIRTY_SUFFIX):
+             task['dirty_file'] = f"{base_name}-v2{ext}"
+             changed = True
+        elif DIRTY_SUFFIX + "-" not in base_name: # Handle cases where it might not have -dirty suffix effectively
+             task['dirty_file'] = f"{base_name}{DIRTY_SUFFIX}-v2{ext}"
+             changed = True
         
         # Enforce NO PEOPLE in prompt
         prompt = task['dirty_prompt']
         if "NO PEOPLE" not in prompt:
-            task['dirty_prompt'] = "ABSOLUTELY NO PEOPLE. EMPTY ROOM. " + prompt
+            task['dirty_prompt'] = NO_PEOPLE_PREFIX + prompt
+            changed = True
 
+    # tasks.json is edited by hand too, so it keeps its indented layout; it is only
+    # rewritten when something actually changed
+    if not changed:
+        print(f"All {len(tasks)} tasks in {TASKS_FILE} are up to date")
+        return
     with open(TASKS_FILE, 'w') as f:
         json.dump(tasks, f, indent=4)
     print(f"Updated {len(tasks)} tasks in {TASKS_FILE}")